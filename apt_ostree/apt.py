@@ -10,8 +10,6 @@ import os
 import subprocess
 import sys
 
-import apt
-
 from apt_ostree.utils import run_sandbox_command
 
 
@@ -21,6 +19,9 @@ class Apt:
         self.state = state
 
     def cache(self, rootfs):
+        # python-apt is slow to import, only load it when needed.
+        import apt
+
         try:
             cache = apt.Cache(rootdir=rootfs)
         except AttributeError as e:
@@ -6,31 +6,51 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
+import errno
 import hashlib
 import logging
 import os
 import shutil
+import stat
 import sys
-import yaml
-
-import apt
-from rich.console import Console
+import tempfile
+import threading
 
+from apt_ostree.constants import CONFIG_HASH_KEY
 from apt_ostree.constants import excluded_packages
 from apt_ostree import exceptions
 from apt_ostree.ostree import Ostree
+from apt_ostree.ui import CONSOLE
 from apt_ostree.utils import run_command
 
+# shutil.copytree() uses the kernel zero-copy paths (sendfile and
+# copy_file_range) on Python >= 3.8 as long as the default copy
+# function is used. Use a larger buffer for the read/write fallback.
+shutil.COPY_BUFSIZE = 4 * 1024 * 1024
+
+# Files left behind by the kernel packages that are not needed in an
+# ostree deployment.
+CRUFT = ("boot/initrd.img", "boot/vmlinuz",
+         "initrd.img", "initrd.img.old",
+         "vmlinuz", "vmlinuz.old")
+
 
 class Bootstrap:
     def __init__(self, state):
         self.logging = logging.getLogger(__name__)
-        self.console = Console()
+        self.console = CONSOLE
         self.state = state
         self.ostree = Ostree(self.state)
+        self._cleanup = None
+        self._init_exc = None
 
     def create_rootfs(self):
         """Create a Debian system from a configuration file."""
+        import yaml
+
+        # Prefer the libyaml backed loader when it is available.
+        Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
         if not self.state.base.exists():
             self.logging.error("Configuration directory does not exist.")
             sys.exit(1)
@@ -43,6 +63,35 @@ class Bootstrap:
         else:
             self.logging.info("Found configuration file bootstrap.yaml.")
 
+        # Parse the configuration before touching the workspace so
+        # that a broken bootstrap.yaml fails early.
+        with open(config, "r") as f:
+            try:
+                config = yaml.load(f, Loader=Loader)
+            except yaml.YAMLError as exc:
+                if hasattr(exc, 'problem_mark'):
+                    mark = exc.problem_mark
+                    line = mark.line+1
+                    col = mark.column+1
+                    msg = \
+                        f"Error in bootstrap.yaml at ({line}:{col})"
+                    raise exceptions.ConfigError(msg)
+                msg = f"Failed to parse bootstrap yaml {exc}"
+                raise exceptions.ConfigError(msg)
+
+        # When asked to, reuse the last commit if the branch was
+        # already built from this exact configuration. mmdebstrap pulls
+        # from a live mirror, so this is opt-in.
+        digest = self.config_hash()
+        if self.state.skip_unchanged and self.state.repo.exists() and \
+                self.ostree.ostree_metadata(
+                    CONFIG_HASH_KEY, self.state.branch) == digest:
+            rev = self.ostree.ostree_ref(self.state.branch)
+            self.logging.info(f"Configuration unchanged since commit "
+                              f"{rev} on {self.state.branch}, reusing it.")
+            self.ostree.ostree_summary_update(self.state.repo)
+            return
+
         with self.console.status(
                 f"Setting up workspace for {self.state.branch}."):
             workspace = self.state.workspace
@@ -54,28 +103,25 @@ class Bootstrap:
             if workdir.exists():
                 self.logging.info("Found working directory from "
                                   "previous run...removing.")
-                shutil.rmtree(workdir)
-
+                # Move the old tree out of the way and delete it in
+                # the background while the new rootfs is built.
+                # mkdtemp gives a name no earlier run can have left
+                # behind, renaming onto the empty directory replaces it.
+                trash = tempfile.mkdtemp(
+                    prefix=f"{workdir.name}.trash-", dir=workdir.parent)
+                os.rename(workdir, trash)
+            # This also picks up trash left behind by runs that were
+            # interrupted before their cleanup finished.
+            if any(self._trash_dirs(workdir)):
+                self._cleanup = threading.Thread(
+                    target=self._remove_trash,
+                    args=(workdir,))
+                self._cleanup.start()
+
+        # The hooks reference files in the configuration directory
+        # relative to the working directory, so copy the whole tree.
         shutil.copytree(self.state.base, workdir)
 
-        cfg = workdir.joinpath("bootstrap.yaml")
-        if not cfg.exists():
-            msg = "Unable to find bootstrap.yaml in %s." % workdir
-            raise exceptions.ConfigError(msg)
-        with open(cfg, "r") as f:
-            try:
-                config = yaml.safe_load(f)
-            except yaml.YAMLError as exc:
-                if hasattr(exc, 'problem_mark'):
-                    mark = exc.problem_mark
-                    line = mark.line+1
-                    col = mark.column+1
-                    msg = \
-                        f"Error in bootstrap.yaml at ({line}:{col})"
-                    raise exceptions.ConError(msg)
-                msg = f"Failed to parse bootstrap yaml {exc}"
-                raise exceptions.ConfigError(msg)
-
         config = config.get("mmdebstrap", None)
         if config is None:
             msg = \
@@ -132,34 +178,40 @@ class Bootstrap:
 
         # Run addtional scripts or copy addtional files into
         # target.
-        setup_hooks = config.get("setup-hooks", None)
-        if setup_hooks:
-            cmd += [f"--setup-hook={hook}" for hook in setup_hooks]
-            
-        extract_hooks = config.get("extract-hooks", None)
-        if extract_hooks:
-            cmd += [f"--extract-hook={hook}" for hook in extract_hooks]
-            
-        customize_hooks = config.get("customize-hooks", None)
-        if customize_hooks:
-            cmd += [f"--customize-hook={hook}" for hook in customize_hooks]
-            
-        hook_directories = config.get("hook_directories", None)
-        if hook_directories:
-            cmd += [f"--hook-directory={direcroty}" for direcroty in hook_directories]
-
-        self.logging.info("Running mmdebstrap.")
-        run_command(cmd, cwd=workdir)
+        hooks = [
+            ("setup-hook", config.get("setup-hooks", None)),
+            ("extract-hook", config.get("extract-hooks", None)),
+            ("customize-hook", config.get("customize-hooks", None)),
+            ("hook-directory", config.get("hook_directories", None)),
+        ]
+        cmd.extend(f"--{flag}={value}"
+                   for flag, values in hooks if values
+                   for value in values)
+
+        # The ostree repository does not depend on the rootfs, so
+        # initialize it while mmdebstrap is running.
+        init = threading.Thread(target=self._init_ostree)
+        init.start()
+        try:
+            self.logging.info("Running mmdebstrap.")
+            run_command(cmd, cwd=workdir)
+        finally:
+            init.join()
+        if self._init_exc is not None:
+            raise self._init_exc
 
-        self.ostree.init()
         self.logging.info(f"Found ostree branch: {self.state.branch}")
         self.create_ostree(rootfs)
+        if self._cleanup is not None:
+            self._cleanup.join()
+            self._cleanup = None
         r = self.ostree.ostree_commit(
             rootfs,
             branch=self.state.branch,
             repo=self.state.repo,
             subject="Commit by apt-ostree",
-            msg="Initialized by apt-ostree.")
+            msg="Initialized by apt-ostree.",
+            metadata={CONFIG_HASH_KEY: digest})
         if r.returncode != 0:
             self.logging.info(f"Failed to commit {self.state.branch} to "
                               f"{self.state.repo}.")
@@ -168,6 +220,38 @@ class Bootstrap:
                               f"{self.state.repo}.")
             self.ostree.ostree_summary_update(self.state.repo)
 
+    def config_hash(self):
+        """Checksum every file in the configuration directory."""
+        h = hashlib.sha256()
+        for path in sorted(self.state.base.rglob("*")):
+            if path.is_file():
+                h.update(str(path.relative_to(self.state.base)).encode())
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        h.update(chunk)
+        return h.hexdigest()
+
+    def _trash_dirs(self, workdir):
+        """Find working directories moved aside for removal."""
+        return workdir.parent.glob(f"{workdir.name}.trash-*")
+
+    def _remove_trash(self, workdir):
+        """Delete the working directories moved aside for removal."""
+        for trash in self._trash_dirs(workdir):
+            try:
+                shutil.rmtree(trash)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logging.warning(f"Failed to remove {trash}: {e}")
+
+    def _init_ostree(self):
+        """Initialize the ostree repository, saving any error."""
+        try:
+            self.ostree.init()
+        except BaseException as e:
+            self._init_exc = e
+
     def create_ostree(self, rootdir):
         """Create an ostree branch from a rootfs."""
         self.logging.info("Setting up kernel and initramfs")
@@ -182,115 +266,138 @@ class Bootstrap:
 
     def convert_to_ostree(self, rootdir):
         """Convert rootfs to ostree."""
-        CRUFT = ["boot/initrd.img", "boot/vmlinuz",
-                 "initrd.img", "initrd.img.old",
-                 "vmlinuz", "vmlinuz.old"]
         assert rootdir is not None and rootdir != ""
 
+        var = rootdir.joinpath("var")
+        usr = rootdir.joinpath("usr")
+        rootdirs = usr.joinpath("rootdirs")
+        rootdirs_var = rootdirs.joinpath("var")
+        dev = rootdir.joinpath("dev")
+
         with self.console.status(f"Converting {rootdir} to ostree."):
             dir_perm = 0o755
             # Copying /var
             self.sanitize_usr_symlinks(rootdir)
             self.logging.info("Moving /var to /usr/rootdirs.")
-            os.mkdir(rootdir.joinpath("usr/rootdirs"), dir_perm)
+            os.mkdir(rootdirs, dir_perm)
             # Make sure we preserve file permissions otherwise
             # bubblewrap will complain that a file/directory
             # permisisons/onership is not mapped correctly.
-            shutil.copytree(
-                rootdir.joinpath("var"),
-                rootdir.joinpath("usr/rootdirs/var"),
-                symlinks=True
-            )
-            shutil.rmtree(rootdir.joinpath("var"))
-            os.mkdir(rootdir.joinpath("var"), dir_perm)
-            
-            shutil.rmtree(rootdir.joinpath("dev"))
-            os.mkdir(rootdir.joinpath("dev"), 0o755)
+            # A rename keeps everything intact without copying data.
+            try:
+                os.rename(var, rootdirs_var)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Keep the default copy function so the zero-copy
+                # fast path is used.
+                shutil.copytree(var, rootdirs_var, symlinks=True)
+                shutil.rmtree(var)
+            os.mkdir(var, dir_perm)
+
+            shutil.rmtree(dev)
+            os.mkdir(dev, 0o755)
 
             # Remove unecessary files
             self.logging.info("Removing unnecessary files.")
-            for c in CRUFT:
+            fd = os.open(rootdir, os.O_DIRECTORY)
+            try:
+                for c in CRUFT:
+                    try:
+                        os.unlink(c, dir_fd=fd)
+                    except FileNotFoundError:
+                        pass
+
+                # Setup and split out etc
+                self.logging.info("Moving /etc to /usr/etc.")
+                shutil.move(rootdir.joinpath("etc"), usr)
+
+                self.logging.info("Setting up /ostree and /sysroot.")
                 try:
-                    os.remove(rootdir.joinpath(c))
+                    rootdir.joinpath("ostree").mkdir(
+                        parents=True, exist_ok=True)
+                    rootdir.joinpath("sysroot").mkdir(
+                        parents=True, exist_ok=True)
                 except OSError:
                     pass
 
-            # Setup and split out etc
-            self.logging.info("Moving /etc to /usr/etc.")
-            shutil.move(rootdir.joinpath("etc"),
-                        rootdir.joinpath("usr"))
+                self.logging.info("Setting up symlinks.")
+                TOPLEVEL_LINKS = {
+                    "home": "var/home",
+                    "media": "run/media",
+                    "mnt": "var/mnt",
+                    "opt": "var/opt",
+                    "ostree": "sysroot/ostree",
+                    "root": "var/roothome",
+                    "srv": "var/srv",
+                    "usr/local": "../var/usrlocal",
+                }
+                for l, t in TOPLEVEL_LINKS.items():
+                    shutil.rmtree(rootdir.joinpath(l))
+                    os.symlink(t, l, dir_fd=fd)
+            finally:
+                os.close(fd)
 
-            self.logging.info("Setting up /ostree and /sysroot.")
+    def sanitize_usr_symlinks(self, rootdir):
+        """Replace symlinks from /usr pointing to /var"""
+        usrdir = os.path.join(rootdir, "usr")
+        usrdir_prefix = usrdir.rstrip(os.sep) + os.sep
+        for entry in self._walk_symlinks(usrdir):
+            p = entry.path
+            base = os.path.dirname(p)
+
+            # Resolve symlink relative to root
+            link = os.readlink(p)
+            if os.path.isabs(link):
+                target = os.path.join(rootdir, link[1:])
+            else:
+                target = os.path.join(base, link)
+
+            rel = os.path.relpath(target, rootdir)
+            # Keep symlinks if they're pointing to a location under /usr
+            if target == usrdir or target.startswith(usrdir_prefix):
+                continue
+
+            toplevel = self.get_toplevel(rel)
+            # Sanitize links going into /var, potentially
+            # other location can be added later
+            if toplevel != 'var':
+                continue
+
+            # A single stat tells us whether the target is a file
+            # or a directory.
             try:
-                rootdir.joinpath("ostree").mkdir(
-                    parents=True, exist_ok=True)
-                rootdir.joinpath("sysroot").mkdir(
-                    parents=True, exist_ok=True)
+                mode = os.stat(target).st_mode
             except OSError:
-                pass
+                mode = 0
 
-            self.logging.info("Setting up symlinks.")
-            TOPLEVEL_LINKS = {
-                "home": "var/home",
-                "media": "run/media",
-                "mnt": "var/mnt",
-                "opt": "var/opt",
-                "ostree": "sysroot/ostree",
-                "root": "var/roothome",
-                "srv": "var/srv",
-                "usr/local": "../var/usrlocal",
-            }
-            fd = os.open(rootdir, os.O_DIRECTORY)
-            for l, t in TOPLEVEL_LINKS.items():
-                shutil.rmtree(rootdir.joinpath(l))
-                os.symlink(t, l, dir_fd=fd)
+            try:
+                os.remove(p)
+                if stat.S_ISREG(mode):
+                    os.link(target, p)
+                elif stat.S_ISDIR(mode):
+                    shutil.copytree(target, p, symlinks=True)
 
-    def sanitize_usr_symlinks(self, rootdir):
-        """Replace symlinks from /usr pointing to /var"""
-        usrdir = os.path.join(rootdir, "usr")
-        for base, dirs, files in os.walk(usrdir):
-            for name in files:
-                p = os.path.join(base, name)
-
-                if not os.path.islink(p):
-                    continue
-
-                # Resolve symlink relative to root
-                link = os.readlink(p)
-                if os.path.isabs(link):
-                    target = os.path.join(rootdir, link[1:])
-                else:
-                    target = os.path.join(base, link)
-
-                rel = os.path.relpath(target, rootdir)
-                # Keep symlinks if they're pointing to a location under /usr
-                if os.path.commonpath([target, usrdir]) == usrdir:
-                    continue
-
-                toplevel = self.get_toplevel(rel)
-                # Sanitize links going into /var, potentially
-                # other location can be added later
-                if toplevel != 'var':
-                    continue
-
-                try :
-                    os.remove(p)
-                    if os.path.isfile(target):
-                        os.link(target, p)
-                    elif os.path.isdir(target):
-                        shutil.copytree(target, p,symlinks=True)
-                    
-                except Exception as e:
-                    self.logging.info(f"Error moving file: {e}")
-                    sys.exit(1)
+            except Exception as e:
+                self.logging.info(f"Error moving file: {e}")
+                sys.exit(1)
+
+    def _walk_symlinks(self, path):
+        """Yield the symlinks below path that os.walk reports as files."""
+        # Snapshot the directory first, the caller replaces the yielded
+        # symlinks with files and directories while we iterate.
+        with os.scandir(path) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.is_symlink():
+                if not entry.is_dir():
+                    yield entry
+            elif entry.is_dir(follow_symlinks=False):
+                yield from self._walk_symlinks(entry.path)
 
     def get_toplevel(self, path):
         """Get the top level diretory."""
-        head, tail = os.path.split(path)
-        while head != '/' and head != '':
-            head, tail = os.path.split(head)
-
-        return tail
+        return path.lstrip(os.sep).split(os.sep, 1)[0]
 
     def setup_boot(self, rootdir, bootdir, targetdir):
         """Setup up the ostree bootdir"""
@@ -317,15 +424,19 @@ class Bootstrap:
                 dtbs = os.path.join(bootdir, item)
             elif item.startswith("System.map"):
                 # Move all other artifacts as is
-                try : 
-                    shutil.move(os.path.join(bootdir, item), targetdir)
+                # bootdir and targetdir are both in the rootfs, so a
+                # plain rename is enough.
+                try:
+                    os.rename(os.path.join(bootdir, item),
+                              os.path.join(targetdir, item))
                 except Exception as e:
                     self.logging.info(f"Error moving file: {e}")
         assert vmlinuz is not None
+        kerneldir = os.path.join(targetdir, version)
 
         try:
             os.rename(os.path.join(bootdir, vmlinuz),
-                      os.path.join(targetdir, version ,"vmlinuz"))
+                      os.path.join(kerneldir, "vmlinuz"))
         except Exception as e:
                     self.logging.info(f"Error moving file: {e}")
                     sys.exit(1)
@@ -333,7 +444,7 @@ class Bootstrap:
         if initrd is not None:
             try:
                 os.rename(os.path.join(bootdir, initrd),
-                          os.path.join(targetdir,version,"initramfs.img"))
+                          os.path.join(kerneldir, "initramfs.img"))
             except Exception as e:
                         self.logging.info(f"Error moving file: {e}")
                         sys.exit(1)
@@ -341,28 +452,27 @@ class Bootstrap:
 
     def create_tmpfile_dir(self, rootdir):
         """Ensure directoeies in /var are created."""
+        import apt
+
         with self.console.status("Creating systemd-tmpfiles configuration"):
             cache = apt.cache.Cache(rootdir=rootdir)
-            dirs = []
-            for pkg in cache:
-                if "/var" in pkg.installed_files and \
-                        pkg.name not in excluded_packages:
-                    dirs += [file for file in pkg.installed_files
-                             if file.startswith("/var")]
+            skip_dirs = {
+                "/var",
+                "/var/lock",
+                "/var/cache",
+                "/var/spool",
+                "/var/log",
+                "/var/lib"}
+            dirs = [f for pkg in cache
+                    if pkg.name not in excluded_packages
+                    for f in pkg.installed_files
+                    if f.startswith("/var") and f not in skip_dirs]
             if len(dirs) == 0:
                 return
             conf = rootdir.joinpath(
                 "usr/lib/tmpfiles.d/ostree-integration-autovar.conf")
             if conf.exists():
                 os.unlink(conf)
-            with open(conf, "w") as f:
-                f.write("# Auto-genernated by apt-ostree\n")
-                for d in (dirs):
-                    if d not in [
-                            "/var",
-                            "/var/lock",
-                            "/var/cache",
-                            "/var/spool",
-                            "/var/log",
-                            "/var/lib"]:
-                        f.write(f"L {d} - - - - ../../usr/rootdirs{d}\n")
+            lines = [f"L {d} - - - - ../../usr/rootdirs{d}" for d in dirs]
+            conf.write_text("# Auto-genernated by apt-ostree\n" +
+                            "\n".join(lines) + "\n")
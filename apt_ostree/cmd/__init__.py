@@ -15,6 +15,7 @@ class State:
         self.branch = None
         self.feed = None
         self.gpg_key = None
+        self.skip_unchanged = False
 
 
 # pass state between command and apt-ostree sub-commands
@@ -12,13 +12,15 @@ import click
 
 from apt_ostree.bootstrap import Bootstrap
 from apt_ostree.cmd.options import compose_options
+from apt_ostree.cmd.options import skip_unchanged_option
 from apt_ostree.cmd import pass_state_context
 
 
 @click.command(short_help="Create treefile.")
 @pass_state_context
 @compose_options
-def create(state, repo, base, branch):
+@skip_unchanged_option
+def create(state, repo, base, branch, skip_unchanged):
     try:
         Bootstrap(state).create_rootfs()
     except KeyboardInterrupt:
@@ -58,6 +58,20 @@ def gpg_key_option(f):
     )(f)
 
 
+def skip_unchanged_option(f):
+    """Skip rebuilding an unchanged configuration option"""
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.skip_unchanged = value
+        return value
+    return click.option(
+        "--skip-unchanged",
+        is_flag=True,
+        help="Reuse the last commit if the configuration is unchanged",
+        callback=callback
+    )(f)
+
+
 def repo_option(f):
     """ostree repo path option"""
     def callback(ctxt, param, value):
@@ -9,22 +9,38 @@ import pathlib
 import shutil
 import sys
 
-
-from rich.console import Console
-
 from apt_ostree.deploy import Deploy
 from apt_ostree.ostree import Ostree
 from apt_ostree.repo import Repo
+from apt_ostree.ui import CONSOLE
+
+
+def _get_cached(state, attr, factory):
+    """Build a client for state once and reuse it afterwards.
+
+    The cached clients copy some fields (e.g. Repo.repo from
+    state.feed) when they are built, so they assume those fields of
+    the state do not change afterwards.
+    """
+    obj = getattr(state, attr, None)
+    if obj is None:
+        obj = factory(state)
+        setattr(state, attr, obj)
+    return obj
 
 
 class Compose:
     def __init__(self, state):
         self.logging = logging.getLogger(__name__)
         self.state = state
-        self.ostree = Ostree(self.state)
-        self.repo = Repo(self.state)
-        self.deploy = Deploy(self.state)
-        self.console = Console()
+        self.ostree = _get_cached(self.state, "_ostree", Ostree)
+        self.deploy = _get_cached(
+            self.state, "_deploy",
+            lambda state: Deploy(state, ostree=self.ostree))
+        self.repo = _get_cached(
+            self.state, "_repo",
+            lambda state: Repo(state, deploy=self.deploy, ostree=self.ostree))
+        self.console = CONSOLE
 
         self.workspace = self.state.workspace
         self.workdir = self.state.workspace.joinpath("deployment")
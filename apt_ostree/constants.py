@@ -8,7 +8,7 @@ SPDX-License-Identifier: Apache-2.0
 VERSION = "0.1"
 
 # packages to exclude from systemd-tmpfiles check.
-excluded_packages = [
+excluded_packages = frozenset({
     "ucf",
     "base-files",
     "systemd",
@@ -17,7 +17,10 @@ excluded_packages = [
     "policykit-1",
     "polkitd",
     "debconf"
-]
+})
+
+# ostree commit metadata key holding the bootstrap configuration checksum.
+CONFIG_HASH_KEY = "apt-ostree.config-hash"
 
 # STX constants
 STX_CONFIG_COMPLETE_FLAG = "/etc/platform/.initial_config_complete"
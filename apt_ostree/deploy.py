@@ -21,11 +21,11 @@ APT_CONF = "etc/apt/sources.list.d/apt-ostree.list"
 
 
 class Deploy:
-    def __init__(self, state):
+    def __init__(self, state, ostree=None):
         self.console = Console()
         self.logging = logging.getLogger(__name__)
         self.state = state
-        self.ostree = Ostree(self.state)
+        self.ostree = ostree or Ostree(self.state)
 
         self.workspace = self.state.workspace
         self.workdir = self.state.workspace.joinpath("deployment")
@@ -121,9 +121,11 @@ class Deploy:
         rev = self.ostree.ostree_ref(branch)
         self.logging.info(f"Checking out {rev[:10]} from {branch}.")
         with self.console.status(f"Checking out {rev[:10]}..."):
-            self.workdir = self.workdir.joinpath(branch)
-            self.workdir.mkdir(parents=True, exist_ok=True)
-            self.rootfs = self.workdir.joinpath(rev)
+            # Derive the checkout directory from the workspace on each
+            # call so that repeated checkouts do not nest.
+            workdir = self.state.workspace.joinpath("deployment", branch)
+            workdir.mkdir(parents=True, exist_ok=True)
+            self.rootfs = workdir.joinpath(rev)
             if self.rootfs.exists():
                 shutil.rmtree(self.rootfs)
             self.ostree.ostree_checkout(branch, self.rootfs)
@@ -63,7 +63,8 @@ class Ostree:
                       branch=None,
                       subject=None,
                       parent=None,
-                      msg=None):
+                      msg=None,
+                      metadata=None):
         """Commit rootfs to ostree repository."""
         cmd = ["ostree",
                "commit",
@@ -80,6 +81,9 @@ class Ostree:
             cmd += [f"--branch={branch}"]
         if parent:
             cmd += [f"--parent={parent}"]
+        if metadata:
+            cmd += [f"--add-metadata-string={k}={v}"
+                    for k, v in metadata.items()]
         if self.state.gpg_key:
             # Ensure the password prompt is displayed if the gpg key is
             # password protected.
@@ -93,6 +97,21 @@ class Ostree:
         self.logging.info(f"Sucessfully commited to {branch}.")
         return r
 
+    def ostree_metadata(self, key, branch, repo=None):
+        """Read a metadata string from the commit of a branch."""
+        if not repo:
+            repo = self.state.repo
+        r = run_command(
+            ["ostree", "show", f"--repo={repo}",
+             f"--print-metadata-key={key}", branch],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False)
+        if r.returncode != 0:
+            return None
+        # The value is printed as a GVariant string, e.g. 'value'.
+        return r.stdout.decode("utf-8").strip().strip("'")
+
     def get_sysroot(self):
         """Load the /ostree directory (sysroot)."""
         sysroot = OSTree.Sysroot()
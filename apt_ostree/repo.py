@@ -5,28 +5,30 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 import logging
+import shutil
 import subprocess
 import sys
-import textwrap
+import tempfile
 
 import click
 from rich.console import Console
 from rich.table import Table
 
 from apt_ostree.deploy import Deploy
+from apt_ostree import exceptions
 from apt_ostree.ostree import Ostree
 from apt_ostree import utils
 
 
 class Repo:
-    def __init__(self, state):
+    def __init__(self, state, deploy=None, ostree=None):
         self.console = Console()
         self.logging = logging.getLogger(__name__)
         self.state = state
         self.repo = self.state.feed
-        self.deploy = Deploy(self.state)
-        self.ostree = Ostree(self.state)
-        self.console = Console()
+        self.deploy = deploy or Deploy(self.state)
+        self.ostree = ostree or Ostree(self.state)
+        self._booted_branch = None
 
         self.label = "StarlingX project udpates."
         self.arch = "amd64"
@@ -48,25 +50,19 @@ class Repo:
             self.logging.info("Creating reprepro configuration.")
             try:
                 config.write_text(
-                    textwrap.dedent(f"""\
-                    Origin: {self.state.origin}
-                    Label: {self.label}
-                    Codename: {self.state.release}
-                    Architectures: amd64
-                    Components: {self.state.origin}
-                    Description: {self.description}
-                    """)
+                    f"Origin: {self.state.origin}\n"
+                    f"Label: {self.label}\n"
+                    f"Codename: {self.state.release}\n"
+                    "Architectures: amd64\n"
+                    f"Components: {self.state.origin}\n"
+                    f"Description: {self.description}\n"
                 )
             except Exception as e:
                 self.logging.error("Error writing distributions \
                                     config file: %s" % str(e))
             options = self.repo.joinpath("options")
             if not options.exists():
-                options.write_text(
-                    textwrap.dedent(f"""\
-                    basedir {self.repo}
-                    """)
-                )
+                options.write_text(f"basedir {self.repo}\n")
 
     def add(self):
         """Add Debian package(s) to a component."""
@@ -75,51 +71,67 @@ class Repo:
 
         utils.check_and_append_component(config, component)
 
-        for pkg in self.state.packages:
-            self.logging.info(
-                f"Adding {pkg} to component {component}.")
-            r = utils.run_command(
-                ["reprepro", "-b", str(self.repo), "-C", component,
-                 "includedeb", self.state.release, pkg])
-            if r.returncode == 0:
-                self.logging.info(
-                    f"Successfully added {pkg} to component {component}\n")
-            else:
-                self.logging.error(
-                    f"Failed to add {pkg} to component {component}\n")
+        if not self.state.packages:
+            return
+
+        # reprepro accepts several packages in a single run, which
+        # either succeeds or raises a CommandError.
+        packages = ", ".join(self.state.packages)
+        self.logging.info(
+            f"Adding {packages} to component {component}.")
+        utils.run_command(
+            ["reprepro", "-b", str(self.repo), "-C", component,
+             "includedeb", self.state.release, *self.state.packages])
+        self.logging.info(
+            f"Successfully added {packages} to component {component}\n")
 
     def show(self):
         """Display a table of packages in the archive."""
         component = self.state.component or self.state.origin
 
-        r = utils.run_command(
-            ["reprepro", "-b", str(self.repo),
-             "-C", component,
-             "list", self.state.release],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            check=False,
-        )
-        # Repo not configured yet
-        if r.returncode == 254:
-            sys.exit(1)
-        if r.returncode != 0:
-            click.secho(r.stdout.decode("utf-8"))
-        if r.stdout and "Exiting" in r.stdout.decode("utf-8"):
-            click.secho(r.stdout.decode("utf-8"))
-        else:
-            table = Table(box=None)
-            table.add_column("Package")
-            table.add_column("Version")
-            table.add_column("Release")
-            table.add_column("Origin")
-            table.add_column("Architecture")
-
-            for line in r.stdout.decode("utf-8").splitlines():
-                (metadata, package, version) = line.split()
+        cmd = ["reprepro", "-b", str(self.repo),
+               "-C", component,
+               "list", self.state.release]
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                encoding="utf-8",
+                bufsize=1,
+            )
+        except FileNotFoundError:
+            msg = "%s is not found in $PATH" % cmd[0]
+            self.logging.error(msg)
+            raise exceptions.CommandError(msg)
+
+        table = Table(box=None)
+        table.add_column("Package")
+        table.add_column("Version")
+        table.add_column("Release")
+        table.add_column("Origin")
+        table.add_column("Architecture")
+
+        # Add the packages as reprepro lists them and keep
+        # anything else around as an error message.
+        errors = []
+        with proc.stdout:
+            for line in proc.stdout:
+                fields = line.split()
+                if len(fields) != 3 or fields[0].count("|") != 2:
+                    errors.append(line)
+                    continue
+                (metadata, package, version) = fields
                 (suite, origin, arch) = metadata.split("|")
                 table.add_row(package, version, suite, origin, arch[:-1])
+        returncode = proc.wait()
 
+        # Repo not configured yet
+        if returncode == 254:
+            sys.exit(1)
+        if returncode != 0 or errors:
+            click.secho("".join(errors))
+        else:
             self.console.print(table)
 
     def remove(self):
@@ -128,19 +140,15 @@ class Repo:
         component = self.state.component or self.state.origin
 
         if self.state.packages:
-            # delete package by package
-            for pkg in self.state.packages:
-                self.logging.info(f"Removing {pkg}.")
-                r = utils.run_command(
-                    ["reprepro", "-b", str(self.repo), "-C", component,
-                     "remove", self.state.release, pkg],
-                    check=True)
-                if r.returncode == 0:
-                    self.logging.info(
-                        f"Removed {pkg} from component {component}\n")
-                else:
-                    self.logging.error(
-                        f"Failed to remove {pkg} from component {component}\n")
+            # delete all of the packages in a single run
+            packages = ", ".join(self.state.packages)
+            self.logging.info(f"Removing {packages}.")
+            utils.run_command(
+                ["reprepro", "-b", str(self.repo), "-C", component,
+                 "remove", self.state.release, *self.state.packages],
+                check=True)
+            self.logging.info(
+                f"Removed {packages} from component {component}\n")
         else:
             # delete the entire component
             config = self.repo.joinpath("conf/distributions")
@@ -150,63 +158,99 @@ class Repo:
                     f"dists/bullseye/{component}")
                 pool_component = self.repo.joinpath(f"pool/{component}")
 
-                try:
-                    utils.run_command(
-                        ["rm", "-r", str(dist_component)],
-                        check=True)
-                except Exception:
-                    self.logging.info(f"Could not remove {dist_component},"
-                                      " skipping anyway\n")
-                try:
-                    utils.run_command(
-                        ["rm", "-r", str(pool_component)],
-                        check=True)
-                except Exception:
-                    self.logging.info(f"Could not remove {pool_component},"
-                                      " skipping anyway\n")
-                try:
-                    utils.run_command(
-                        ["reprepro", "-b", str(self.repo),
-                         "--delete", "clearvanished"],
-                        check=True)
-                except Exception:
-                    self.logging.info("Could not run reprepro clearvanished,"
-                                      " skipping anyway\n")
-                try:
-                    utils.run_command(
-                        ["reprepro", "-b", str(self.repo),
-                         "deleteunreferenced"],
-                        check=True)
-                except Exception:
-                    self.logging.info("Could not run reprepro "
-                                      "deleteunreferenced, skipping anyway\n")
+                found = False
+                for path in (dist_component, pool_component):
+                    if not path.exists():
+                        continue
+                    found = True
+                    try:
+                        shutil.rmtree(path)
+                    except OSError:
+                        self.logging.info(f"Could not remove {path},"
+                                          " skipping anyway\n")
+
+                # Both passes walk the whole archive, there is nothing
+                # for them to clean up if the component had no files.
+                if found:
+                    try:
+                        utils.run_command(
+                            ["reprepro", "-b", str(self.repo),
+                             "--delete", "clearvanished"],
+                            check=True)
+                    except Exception:
+                        self.logging.info("Could not run reprepro "
+                                          "clearvanished, skipping anyway\n")
+                    try:
+                        utils.run_command(
+                            ["reprepro", "-b", str(self.repo),
+                             "deleteunreferenced"],
+                            check=True)
+                    except Exception:
+                        self.logging.info("Could not run reprepro "
+                                          "deleteunreferenced, "
+                                          "skipping anyway\n")
 
                 self.logging.info(f"Removed component {component}\n")
             else:
                 self.logging.error(f"Failed to remove component {component}\n")
 
-    def disable_repo(self):
-        """Disable Debian feed via apt-add-repository."""
-        rootfs = self.deploy.get_sysroot()
-        branch = self.ostree.get_branch()
+    @property
+    def branch(self):
+        """The ostree branch to work on.
+
+        Only the lookup of the booted deployment is cached, an explicit
+        branch is always read from the state.
+        """
+        if self.state.branch:
+            return self.state.branch
+        if self._booted_branch is None:
+            self._booted_branch = self.ostree.get_branch()
+        return self._booted_branch
+
+    def _get_sources(self, sources=None):
+        """Return the package feeds to work on as a list."""
+        if sources is None:
+            sources = self.state.sources
+        if isinstance(sources, str):
+            return [sources]
+        return list(sources)
+
+    def _apt_add_repository(self, args, rootfs):
+        """Run apt-add-repository in the rootfs.
+
+        The output is spooled to a temporary file and only read back
+        to be logged if the command fails.
+        """
+        with tempfile.TemporaryFile() as output:
+            r = utils.run_sandbox_command(
+                ["apt-add-repository", *args],
+                rootfs,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                check=False)
+            if r.returncode != 0:
+                output.seek(0)
+                self.logging.error(
+                    output.read().decode("utf-8", errors="replace"))
+        return r.returncode == 0
+
+    def disable_repo(self, sources=None):
+        """Disable Debian feed(s) via apt-add-repository."""
+        sources = self._get_sources(sources)
+        branch = self.branch
+        rootfs = self.deploy.get_sysroot(branch)
         self.deploy.prestaging(rootfs)
         self.logging.info(
             "Disablng Debian package feeds.")
-        cmd = [
-            "apt-add-repository",
-            "-r", "-y", "-n",
-            self.state.sources
-        ]
-        r = utils.run_sandbox_command(
-            cmd,
-            rootfs,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        if r.returncode != 0:
-            self.logging.error("Failed to disable package feed.")
-            sys.exit(1)
-        self.logging.info(
-            f"Successfully disabled  \"{self.state.sources}\".")
+        # apt-add-repository edits the shared sources.list, so the
+        # feeds are handled one after another in the same checkout.
+        for source in sources:
+            if not self._apt_add_repository(
+                    ["-r", "-y", "-n", source], rootfs):
+                self.logging.error("Failed to disable package feed.")
+                sys.exit(1)
+            self.logging.info(
+                f"Successfully disabled  \"{source}\".")
         self.deploy.poststaging(rootfs)
 
         self.logging.info(f"Committing to {branch} to repo.")
@@ -215,36 +259,31 @@ class Repo:
             branch=branch,
             repo=self.state.repo,
             subject="Disabled package feed.",
-            msg=f"Disabled {self.state.sources}",
+            msg=f"Disabled {', '.join(sources)}",
         )
         if r.returncode != 0:
             self.logging.error("Failed to commit to repository.")
         else:
             self.ostree.ostree_summary_update(self.state.repo)
-        self.deploy.cleanup(str(rootfs))
+        self.deploy.cleanup(rootfs)
 
-    def add_repo(self):
-        """Enable Debian feed via apt-add-repository."""
-        rootfs = self.deploy.get_sysroot()
-        branch = self.ostree.get_branch()
+    def add_repo(self, sources=None):
+        """Enable Debian feed(s) via apt-add-repository."""
+        sources = self._get_sources(sources)
+        branch = self.branch
+        rootfs = self.deploy.get_sysroot(branch)
         self.deploy.prestaging(rootfs)
         self.logging.info(
             "Enabling addtional Debian package feeds.")
-        cmd = [
-            "apt-add-repository",
-            "-y", "-n",
-            self.state.sources
-        ]
-        r = utils.run_sandbox_command(
-            cmd,
-            rootfs,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        if r.returncode != 0:
-            self.logging.error("Failed to add package feed.")
-            sys.exit(1)
-        self.logging.info(
-            f"Successfully added \"{self.state.sources}\".")
+        # apt-add-repository edits the shared sources.list, so the
+        # feeds are handled one after another in the same checkout.
+        for source in sources:
+            if not self._apt_add_repository(
+                    ["-y", "-n", source], rootfs):
+                self.logging.error("Failed to add package feed.")
+                sys.exit(1)
+            self.logging.info(
+                f"Successfully added \"{source}\".")
         self.deploy.poststaging(rootfs)
 
         self.logging.info(f"Committing to {branch} to repo.")
@@ -253,10 +292,10 @@ class Repo:
             branch=branch,
             repo=self.state.repo,
             subject="Enable package feed.",
-            msg=f"Enabled {self.state.sources}",
+            msg=f"Enabled {', '.join(sources)}",
         )
         if r.returncode != 0:
             self.logging.error("Failed to commit to repository")
         else:
             self.ostree.ostree_summary_update(self.state.repo)
-        self.deploy.cleanup(str(rootfs))
+        self.deploy.cleanup(rootfs)
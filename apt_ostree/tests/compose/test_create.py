@@ -21,3 +21,9 @@ class TestComposeCLI(base.TestCase):
         runner = CliRunner()
         result = runner.invoke(cli, ["compose", "image", "--help"])
         assert result.exit_code == 0
+
+    def test_compose_create_skip_unchanged(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ["compose", "create", "--help"])
+        assert result.exit_code == 0
+        assert "--skip-unchanged" in result.output
@@ -0,0 +1,54 @@
+"""
+Copyright (c) 2026 Ivan Ucherdzhiev
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import pathlib
+import tempfile
+from unittest import mock
+
+from apt_ostree import bootstrap
+from apt_ostree.cmd import State
+from apt_ostree.tests import base
+
+
+class TestBootstrap(base.TestCase):
+
+    def setUp(self):
+        super(TestBootstrap, self).setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        tmpdir = pathlib.Path(tmpdir.name)
+
+        self.state = State()
+        self.state.base = tmpdir.joinpath("config")
+        self.state.base.mkdir()
+        self.state.base.joinpath("bootstrap.yaml").write_text(
+            "mmdebstrap:\n  suite: bookworm\n")
+        self.state.repo = tmpdir.joinpath("repo")
+        self.state.repo.mkdir()
+        self.state.workspace = tmpdir.joinpath("workspace")
+        self.state.branch = "debian/bookworm"
+
+        self.bootstrap = bootstrap.Bootstrap(self.state)
+        self.bootstrap.ostree = mock.Mock()
+        self.bootstrap.ostree.ostree_metadata.return_value = \
+            self.bootstrap.config_hash()
+        self.bootstrap.ostree.ostree_ref.return_value = "0123456789abcdef"
+
+    def test_create_rootfs_unchanged(self):
+        self.state.skip_unchanged = True
+        with mock.patch.object(bootstrap, "run_command") as run_command:
+            self.bootstrap.create_rootfs()
+        run_command.assert_not_called()
+        self.bootstrap.ostree.ostree_summary_update.assert_called_once_with(
+            self.state.repo)
+        self.assertFalse(self.state.workspace.exists())
+
+    def test_config_hash_changes_with_config(self):
+        digest = self.bootstrap.config_hash()
+        self.state.base.joinpath("overlay").mkdir()
+        self.state.base.joinpath("overlay/hostname").write_text("apt\n")
+        self.assertNotEqual(digest, self.bootstrap.config_hash())
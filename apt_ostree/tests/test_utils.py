@@ -0,0 +1,66 @@
+"""
+Copyright (c) 2026 Ivan Ucherdzhiev
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import pathlib
+import tempfile
+from unittest import mock
+
+from apt_ostree.tests import base
+from apt_ostree import utils
+
+DISTRIBUTIONS = """\
+Origin: updates
+Codename: bookworm
+Components: updates 24.03.1
+Description: Apt repository for StarlingX updates.
+
+Origin: extra
+Codename: trixie
+Components: extra
+"""
+
+
+class TestComponentConfig(base.TestCase):
+
+    def setUp(self):
+        super(TestComponentConfig, self).setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.config = pathlib.Path(tmpdir.name).joinpath("distributions")
+        self.config.write_text(DISTRIBUTIONS)
+
+    def test_append_component(self):
+        utils.check_and_append_component(self.config, "24.03.2")
+        self.assertEqual(
+            DISTRIBUTIONS.replace("Components: updates 24.03.1",
+                                  "Components: updates 24.03.1 24.03.2"),
+            self.config.read_text())
+
+    def test_append_existing_component(self):
+        with mock.patch.object(pathlib.Path, "write_text") as write_text:
+            utils.check_and_append_component(self.config, "24.03.1")
+        write_text.assert_not_called()
+        self.assertEqual(DISTRIBUTIONS, self.config.read_text())
+
+    def test_remove_component(self):
+        self.assertTrue(
+            utils.remove_component_from_config(self.config, "24.03.1"))
+        # Components lines without the component are left untouched.
+        self.assertEqual(
+            DISTRIBUTIONS.replace("Components: updates 24.03.1",
+                                  "Components: updates"),
+            self.config.read_text())
+
+    def test_remove_missing_component(self):
+        self.assertFalse(
+            utils.remove_component_from_config(self.config, "24.03.2"))
+        self.assertEqual(DISTRIBUTIONS, self.config.read_text())
+
+    def test_remove_component_missing_config(self):
+        self.assertFalse(
+            utils.remove_component_from_config(
+                self.config.with_name("missing"), "24.03.1"))
@@ -0,0 +1,11 @@
+"""
+Copyright (c) 2026 Ivan Ucherdzhiev
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+from rich.console import Console
+
+# Shared console, probing the terminal once per process.
+CONSOLE = Console()
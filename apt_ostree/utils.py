@@ -5,8 +5,12 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
+import functools
 import logging
 import os
+import pathlib
+import re
+import shutil
 import subprocess
 
 from apt_ostree import constants
@@ -14,7 +18,12 @@ from apt_ostree import exceptions
 
 LOG = logging.getLogger(__name__)
 
+# Matches any of the StarlingX keywords, regardless of case.
+_STX_RE = re.compile(
+    "|".join(re.escape(k) for k in constants.STX_KEYWORDS), re.IGNORECASE)
 
+
+@functools.lru_cache(maxsize=1)
 def is_stx_system():
     """Return True if running in a host running StarlingX"""
 
@@ -22,14 +31,10 @@ def is_stx_system():
         if not os.path.exists(constants.STX_BUILD_INFO_FILE):
             return False
 
-        with open(constants.STX_BUILD_INFO_FILE, 'r') as file:
-            build_info_content = file.read()
-
-        for keyword in constants.STX_KEYWORDS:
-            if keyword in build_info_content.lower():
-                return True
+        build_info_content = pathlib.Path(
+            constants.STX_BUILD_INFO_FILE).read_text()
 
-        return False
+        return bool(_STX_RE.search(build_info_content))
 
     except Exception:
         msg = "Failed to determine if apt-ostree " \
@@ -38,6 +43,7 @@ def is_stx_system():
         raise
 
 
+@functools.lru_cache(maxsize=1)
 def is_pre_stx_bootstrap():
     """Return True if in STX system pre-bootstrap
 
@@ -49,9 +55,21 @@ def is_pre_stx_bootstrap():
         not os.path.exists(constants.STX_CONFIG_COMPLETE_FLAG)
 
 
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    """Resolve a command name to its path once per process."""
+    return shutil.which(name) or name
+
+
 def parse_subprocess_result(result):
     """Extracting info from subprocess.run() output for logging"""
 
+    # Nothing was captured and the command succeeded.
+    if not getattr(result, "returncode", None) and \
+            getattr(result, "stdout", None) is None and \
+            getattr(result, "stderr", None) is None:
+        return ""
+
     msg = "Results:\n"
 
     try:
@@ -85,9 +103,13 @@ def run_command(cmd,
                 env=None,
                 cwd=None):
     """Run a command in a shell."""
-    _env = os.environ.copy()
+    # Let the child inherit the environment unless there is
+    # something to add to it.
+    _env = None
     if env:
-        _env.update(env)
+        _env = {**os.environ, **env}
+    if isinstance(cmd, list) and cmd and not (env and "PATH" in env):
+        cmd = [_which(cmd[0])] + cmd[1:]
     try:
         subprocess_result = subprocess.run(
             cmd,
@@ -99,8 +121,10 @@ def run_command(cmd,
             check=check,
         )
 
-        msg = parse_subprocess_result(subprocess_result)
-        LOG.info(msg)
+        # Only captured output is worth logging.
+        if LOG.isEnabledFor(logging.INFO) and \
+                subprocess.PIPE in (stdout, stderr):
+            LOG.info(parse_subprocess_result(subprocess_result))
 
         return subprocess_result
 
@@ -115,17 +139,10 @@ def run_command(cmd,
         raise exceptions.CommandError(msg)
 
 
-def run_sandbox_command(
-    args,
-    rootfs,
-    stdin=None,
-    stdout=None,
-    stderr=None,
-    check=True,
-    env=None
-):
-    """Run a shell wrapped with bwrap."""
-    cmd = [
+@functools.lru_cache(maxsize=8)
+def _bwrap_prefix(rootfs, pre_stx):
+    """Build the bwrap arguments for a rootfs."""
+    cmd = (
         "bwrap",
         "--proc", "/proc",
         "--dev", "/dev",
@@ -145,12 +162,25 @@ def run_sandbox_command(
         "--share-net",
         "--die-with-parent",
         "--chdir", "/",
-    ]
+    )
+
+    if pre_stx:
+        cmd += ("--bind", "/var/www/pages/updates", "/var/www/pages/updates")
 
-    if is_pre_stx_bootstrap():
-        cmd += ["--bind", "/var/www/pages/updates", "/var/www/pages/updates"]
+    return cmd
 
-    cmd += args
+
+def run_sandbox_command(
+    args,
+    rootfs,
+    stdin=None,
+    stdout=None,
+    stderr=None,
+    check=True,
+    env=None
+):
+    """Run a shell wrapped with bwrap."""
+    cmd = [*_bwrap_prefix(str(rootfs), is_pre_stx_bootstrap()), *args]
 
     return run_command(
         cmd,
@@ -163,50 +193,45 @@ def run_sandbox_command(
 
 
 def check_and_append_component(config_path, component):
-    with open(config_path, 'r') as file:
-        lines = file.readlines()
+    config = pathlib.Path(config_path)
+    text = config.read_text()
 
-    for i, line in enumerate(lines):
-        if line.startswith("Components:"):
-            components = line.split()[1:]
-            if component not in components:
-                lines[i] = line.strip() + f" {component}\n"
-            break
+    match = re.search(r"^(Components:.*?)[ \t]*$", text, re.M)
+    if match is None or component in match.group(1).split()[1:]:
+        return
 
-    with open(config_path, 'w') as file:
-        file.writelines(lines)
+    text = text[:match.end(1)] + f" {component}" + text[match.end():]
+    config.write_text(text)
 
 
 def remove_component_from_config(config_path, component):
+    config = pathlib.Path(config_path)
     try:
-        with open(config_path, 'r') as file:
-            lines = file.readlines()
+        text = config.read_text()
     except FileNotFoundError:
         msg = "The file %s does not exist." % config_path
         LOG.error(msg)
         return False
 
-    updated_lines = []
     component_found = False
-    for line in lines:
-        if line.startswith("Components:"):
-            components = line.split()[1:]
-            if component in components:
-                components.remove(component)
-                component_found = True
-
-                updated_line = "Components: " + " ".join(components) + "\n"
-                updated_lines.append(updated_line)
-        else:
-            updated_lines.append(line)
+
+    def _remove(match):
+        nonlocal component_found
+        components = match.group(1).split()
+        if component not in components:
+            return match.group(0)
+        components.remove(component)
+        component_found = True
+        return "Components: " + " ".join(components)
+
+    text = re.sub(r"^Components:(.*)$", _remove, text, flags=re.M)
 
     if not component_found:
         msg = "Component %s not found in the configuration." % component
         LOG.error(msg)
         return False
 
-    with open(config_path, 'w') as file:
-        file.writelines(updated_lines)
+    config.write_text(text)
 
     LOG.info("Component %s removed from %s successfully"
              % (component, config_path))